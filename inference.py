@@ -3,41 +3,116 @@ __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
 import argparse
 import time
-import librosa
+import copy
 from tqdm import tqdm
 import sys
 import os
-import copy
-import glob
+import inspect
+import zipfile
+import concurrent.futures
 import torch
+import torchaudio
 import numpy as np
 import soundfile as sf
 import torch.nn as nn
-from utils import demix_track, demix_track_demucs, get_model_from_config
+from utils import demix_track, demix_track_demucs, demix_tracks, demix_tracks_demucs, get_model_from_config
 
 import warnings
 warnings.filterwarnings("ignore")
 
+MAX_DECODE_WORKERS = 4
+# Audio file extensions picked up by run_folder. The ones soundfile can't open
+# (mp3 on old libsndfile, m4a, aac) go through the torchaudio fallback in read_audio
+AUDIO_EXTENSIONS = (
+    '.wav', '.flac', '.aif', '.aiff', '.ogg', '.opus', '.mp3',
+    '.m4a', '.aac', '.w64', '.rf64', '.caf', '.au',
+)
+
+# Chunks fed to the model always have the same shape, so cudnn autotuning pays off once per process
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+
 def stereo_widering(wave, value):
     n = (100 - value) / 100
-    k1 = .5 + n / 2
-    k2 = .5 - n / 2
-    wave0 = copy.copy(wave[0])
-    wave[0] = wave[0] * (k1 / n) - wave[1] * (k2 / n)
-    wave[1] = wave[1] * (k1 / n) - wave0 * (k2 / n)
-    
+    k1 = (.5 + n / 2) / n
+    k2 = (.5 - n / 2) / n
+    # wave is (length, 2); both channels in a single pass: [L, R] <- [L, R] @ [[k1, -k2], [-k2, k1]]
+    m = np.array([[k1, -k2], [-k2, k1]], dtype=wave.dtype)
+    np.matmul(wave, m, out=wave)
+
     return wave
-    
+
+
 def stereo_narrowing(wave, value):
     n = 100 - value
     k1 = (50 + n / 2) / 100
     k2 = (50 - n / 2) / 100
-    wave0 = copy.copy(wave[0])
-    wave[0] = wave[0] * k1 + wave[1] * k2
-    wave[1] = wave[1] * k1 + wave0 * k2
-    
+    m = np.array([[k1, k2], [k2, k1]], dtype=wave.dtype)
+    np.matmul(wave, m, out=wave)
+
     return wave
-    
+
+
+def read_audio(path, device='cpu', sr=44100):
+    # Fast path: file is already at target sample rate, soundfile decodes straight to float32
+    try:
+        file_sr = sf.info(path).samplerate
+    except RuntimeError:
+        file_sr = None
+    if file_sr == sr:
+        mix, _ = sf.read(path, dtype='float32', always_2d=True)
+        return mix, sr
+
+    # Otherwise decode with torchaudio and resample on the target device
+    wav, file_sr = torchaudio.load(path)
+    if file_sr != sr:
+        wav = torchaudio.functional.resample(wav.to(device), file_sr, sr)
+    return wav.cpu().numpy().T, sr
+
+
+class MixDataset(torch.utils.data.Dataset):
+    # Decodes mixtures in DataLoader workers so reading the next track overlaps with inference
+    def __init__(self, paths, sr=44100):
+        self.paths = paths
+        self.sr = sr
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        try:
+            mix, sr = read_audio(path, sr=self.sr)
+        except Exception as e:
+            return path, None, str(e)
+
+        # Convert mono to stereo if needed (a view, the contiguous copy below materializes it)
+        if mix.shape[1] == 1:
+            mix = np.broadcast_to(mix, (mix.shape[0], 2))
+
+        return path, torch.from_numpy(np.ascontiguousarray(mix.T, dtype=np.float32)), None
+
+
+def collate_single(batch):
+    return batch[0]
+
+
+def write_audio(path, data, sr, subtype='FLOAT'):
+    # Stream (length, channels) audio to disk one second at a time, so soundfile only
+    # needs a contiguous copy of the current block rather than of the whole track
+    with sf.SoundFile(path, 'w', sr, data.shape[1], subtype) as f:
+        for i in range(0, data.shape[0], sr):
+            f.write(data[i:i + sr])
+
+
+def wait_for_writes(write_jobs, max_pending=0):
+    # Block until at most max_pending writes are left in the queue, re-raising write errors
+    while len(write_jobs) > max_pending:
+        write_jobs.pop(0).result()
+
+
 def run_single_file(model, args, config, device, verbose=False):
     start_time = time.time()
     model.eval()
@@ -52,27 +127,26 @@ def run_single_file(model, args, config, device, verbose=False):
         os.mkdir(args.store_dir)
 
     try:
-        mix, sr = librosa.load(args.input_file, sr=44100, mono=False)
-        is_stereo = mix.shape[0] == 2
+        mix, sr = read_audio(args.input_file, device)
+        is_stereo = mix.shape[1] == 2
         if args.stereo_narrowing != 0 and is_stereo:
             mix = stereo_narrowing(mix, args.stereo_narrowing)
-        mix = mix.T
+        # Convert mono to stereo if needed (a view, the contiguous copy below materializes it)
+        if mix.shape[1] == 1:
+            mix = np.broadcast_to(mix, (mix.shape[0], 2))
         original_length = mix.shape[0]
-        
-        # Adding 5 seconds of silence to fix the bug
-        silence_duration = 5 
-        silence = np.zeros((silence_duration * sr, mix.shape[1]))
-        mix = np.vstack([mix, silence])
     except Exception as e:
         print('Can read track: {}'.format(args.input_file))
         print('Error message: {}'.format(str(e)))
         return
 
-    # Convert mono to stereo if needed
-    if len(mix.shape) == 1:
-        mix = np.stack([mix, mix], axis=-1)
-        
-    mixture = torch.tensor(mix.T, dtype=torch.float32)
+    mixture = torch.from_numpy(np.ascontiguousarray(mix.T, dtype=np.float32)).to(device)
+
+    # Adding 5 seconds of silence to fix the bug (only htdemucs needs it)
+    silence_duration = 5 if args.model_type == 'htdemucs' else 0
+    if silence_duration > 0:
+        mixture = nn.functional.pad(mixture, (0, silence_duration * sr))
+
     if args.model_type == 'htdemucs':
         res = demix_track_demucs(config, model, mixture, device)
     else:
@@ -82,236 +156,247 @@ def run_single_file(model, args, config, device, verbose=False):
     if config.training.target_instrument is not None:
         instruments = [config.training.target_instrument]
 
-    for instr in instruments:
-        res[instr] = res[instr][:, :original_length] # Removing the last 5 seconds of silence
-        if args.stereo_narrowing != 0 and is_stereo:
-            sf.write("{}/{}_{}.wav".format(args.store_dir, os.path.basename(args.input_file)[:-4], instr), stereo_widering(res[instr], args.stereo_narrowing).T, sr, subtype='FLOAT')
-        else:
-            sf.write("{}/{}_{}.wav".format(args.store_dir, os.path.basename(args.input_file)[:-4], instr), res[instr].T, sr, subtype='FLOAT')
-
+    # Stems are written in parallel
+    write_jobs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as writer:
+        for instr in instruments:
+            # Removing the added silence, as a single contiguous (length, channels) array
+            out = np.ascontiguousarray(res[instr][:, :original_length].T)
+            if args.stereo_narrowing != 0 and is_stereo:
+                out = stereo_widering(out, args.stereo_narrowing)
+            write_jobs.append(writer.submit(write_audio, "{}/{}_{}.wav".format(args.store_dir, os.path.basename(args.input_file)[:-4], instr), out, sr, args.output_subtype))
+        wait_for_writes(write_jobs)
+
+
+def group_tracks(loader, max_length):
+    # Collects consecutive tracks into groups of at most max_length samples in total
+    # (a longer track forms a group on its own) to separate them in shared batches
+    group = []
+    group_length = 0
+    for path, mixture, error in loader:
+        if mixture is None:
+            print('Can read track: {}'.format(path))
+            print('Error message: {}'.format(error))
+            continue
+        if len(group) > 0 and group_length + mixture.shape[-1] > max_length:
+            yield group
+            group = []
+            group_length = 0
+        group.append((path, mixture))
+        group_length += mixture.shape[-1]
+    if len(group) > 0:
+        yield group
 
-def run_folder(model, args, config, device, verbose=False):
-    start_time = time.time()
-    model.eval()
-    all_mixtures_path = glob.glob(args.input_folder + '/*.*')
-    print('Total files found: {}'.format(len(all_mixtures_path)))
 
+def proc_list_of_files(mixture_paths, model, args, config, device, verbose=False, num_workers=None):
     instruments = config.training.instruments
     if config.training.target_instrument is not None:
         instruments = [config.training.target_instrument]
 
-    if not os.path.isdir(args.store_dir):
-        os.mkdir(args.store_dir)
-
+    sr = 44100
+    if num_workers is None:
+        num_workers = os.cpu_count() // 2
+    # Every worker keeps its decoded (pinned) tracks in memory, a few tracks ahead are enough to keep the GPU busy
+    num_workers = min(MAX_DECODE_WORKERS, num_workers)
+    loader = torch.utils.data.DataLoader(
+        MixDataset(mixture_paths, sr=sr),
+        batch_size=1,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        collate_fn=collate_single,
+        prefetch_factor=1 if num_workers > 0 else None,
+    )
     if not verbose:
-        all_mixtures_path = tqdm(all_mixtures_path)
-
-    for path in all_mixtures_path:
-        if not verbose:
-            all_mixtures_path.set_postfix({'track': os.path.basename(path)})
-        try:
-            # mix, sr = sf.read(path)
-            mix, sr = librosa.load(path, sr=44100, mono=False)
-            mix = mix.T
-        except Exception as e:
-            print('Can read track: {}'.format(path))
-            print('Error message: {}'.format(str(e)))
-            continue
-
-        # Convert mono to stereo if needed
-        if len(mix.shape) == 1:
-            mix = np.stack([mix, mix], axis=-1)
-
-        mixture = torch.tensor(mix.T, dtype=torch.float32)
-        if args.model_type == 'htdemucs':
-            res = demix_track_demucs(config, model, mixture, device)
-        else:
-            res = demix_track(config, model, mixture, device)
-        for instr in instruments:
-            sf.write("{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], instr), res[instr].T, sr, subtype='FLOAT')
-
-        if 'vocals' in instruments and args.extract_instrumental:
-            instrum_file_name = "{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], 'instrumental')
-            sf.write(instrum_file_name, mix - res['vocals'].T, sr, subtype='FLOAT')
-
-    time.sleep(1)
-    print("Elapsed time: {:.2f} sec".format(time.time() - start_time))
+        loader = tqdm(loader)
 
+    # Results are written in the background while the next group of tracks is processed
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    write_jobs = []
+    extract_instrumental = 'vocals' in instruments and args.extract_instrumental
 
-def proc_single_file(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model_type", type=str, default='mdx23c', help="One of mdx23c, htdemucs, segm_models, mel_band_roformer, bs_roformer, swin_upernet, bandit")
-    parser.add_argument("--config_path", type=str, help="path to config file")
-    parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights")
-    #parser.add_argument("--input_folder", type=str, help="folder with mixtures to process")
-    parser.add_argument("--input_file", type=str, help="path to input audio file")
-    parser.add_argument("--store_dir", default="", type=str, help="path to store results as wav file")
-    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
-    parser.add_argument("--extract_instrumental", action='store_true', help="invert vocals to get instrumental if provided")
-    if args is None:
-        args = parser.parse_args()
-    else:
-        args = parser.parse_args(args)
-
-    torch.backends.cudnn.benchmark = True
+    for group in group_tracks(loader, int(args.group_duration * sr)):
+        if not verbose:
+            loader.set_postfix({'track': os.path.basename(group[-1][0])})
 
-    model, config = get_model_from_config(args.model_type, args.config_path)
-    if args.start_check_point != '':
-        print('Start from checkpoint: {}'.format(args.start_check_point))
-        state_dict = torch.load(args.start_check_point)
+        mixtures = [mixture.to(device, non_blocking=True) for _, mixture in group]
         if args.model_type == 'htdemucs':
-            # Fix for htdemucs pround etrained models
-            if 'state' in state_dict:
-                state_dict = state_dict['state']
-        model.load_state_dict(state_dict)
-    print("Instruments: {}".format(config.training.instruments))
-
-    if torch.cuda.is_available():
-        device_ids = args.device_ids
-        if type(device_ids)==int:
-            device = torch.device(f'cuda:{device_ids}')
-            model = model.to(device)
+            results = demix_tracks_demucs(config, model, mixtures, device)
         else:
-            device = torch.device(f'cuda:{device_ids[0]}')
-            model = nn.DataParallel(model, device_ids=device_ids).to(device)
-    else:
-        device = 'cpu'
-        print('CUDA is not avilable. Run inference on CPU. It will be very slow...')
-        model = model.to(device)
-
-    run_single_file(model, args, config, device, verbose=False)
-
-
-if __name__ == "__main__":
-    if not os.path.isdir(args.store_dir):
-        os.mkdir(args.store_dir)
-
-    try:
-        mix, sr = librosa.load(args.input_file, sr=44100, mono=False)
-        mix = mix.T
-        original_length = mix.shape[0]
-        
-        # Adding 5 seconds of silence to fix the bug
-        silence_duration = 5 
-        silence = np.zeros((silence_duration * sr, mix.shape[1]))
-        mix = np.vstack([mix, silence])
-    except Exception as e:
-        print('Can read track: {}'.format(args.input_file))
-        print('Error message: {}'.format(str(e)))
-        return
-
-    # Convert mono to stereo if needed
-    if len(mix.shape) == 1:
-        mix = np.stack([mix, mix], axis=-1)
-
-    mixture = torch.tensor(mix.T, dtype=torch.float32)
-    if args.model_type == 'htdemucs':
-        res = demix_track_demucs(config, model, mixture, device)
-    else:
-        res = demix_track(config, model, mixture, device)
-
-    instruments = config.training.instruments
-    if config.training.target_instrument is not None:
-        instruments = [config.training.target_instrument]
-
-    for instr in instruments:
-        res[instr] = res[instr][:, :original_length] # Removing the last 5 seconds of silence
-        sf.write("{}/{}_{}.wav".format(args.store_dir, os.path.basename(args.input_file)[:-4], instr), res[instr].T, sr, subtype='FLOAT')
+            results = demix_tracks(config, model, mixtures, device)
+
+        for (path, mixture), res in zip(group, results):
+            for instr in instruments:
+                write_jobs.append(writer.submit(write_audio, "{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], instr), res[instr].T, sr, args.output_subtype))
+
+            if extract_instrumental:
+                instrum_file_name = "{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], 'instrumental')
+                # Both arrays are contiguous (channels, length), so subtract before transposing
+                write_jobs.append(writer.submit(write_audio, instrum_file_name, (mixture.numpy() - res['vocals']).T, sr, args.output_subtype))
+
+        # Don't let results pile up in memory if the disk is slower than the model:
+        # writes of the previous group must be done before the next one is separated
+        wait_for_writes(write_jobs, len(group) * (len(instruments) + int(extract_instrumental)))
+
+    wait_for_writes(write_jobs)
+    writer.shutdown(wait=True)
+
+
+def run_folder_mp(proc_id, all_mixtures_path, model, args, config):
+    device_ids = args.device_ids
+    device = torch.device('cuda:{}'.format(device_ids[proc_id]))
+    torch.cuda.set_device(device)
+    model = model.to(device)
+    if args.compile:
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+    # Every process separates its own share of the files, CPU decode workers are split between them
+    proc_list_of_files(
+        all_mixtures_path[proc_id::len(device_ids)],
+        model,
+        args,
+        config,
+        device,
+        num_workers=os.cpu_count() // (2 * len(device_ids)),
+    )
 
 
 def run_folder(model, args, config, device, verbose=False):
     start_time = time.time()
     model.eval()
-    all_mixtures_path = glob.glob(args.input_folder + '/*.*')
+    # Only audio files, sorted by size: similar length tracks next to each other make groups of short tracks
+    entries = [e for e in os.scandir(args.input_folder) if e.is_file() and e.name.lower().endswith(AUDIO_EXTENSIONS)]
+    all_mixtures_path = [e.path for e in sorted(entries, key=lambda e: e.stat().st_size)]
     print('Total files found: {}'.format(len(all_mixtures_path)))
 
-    instruments = config.training.instruments
-    if config.training.target_instrument is not None:
-        instruments = [config.training.target_instrument]
-
     if not os.path.isdir(args.store_dir):
         os.mkdir(args.store_dir)
 
-    if not verbose:
-        all_mixtures_path = tqdm(all_mixtures_path)
+    device_ids = args.device_ids
+    if torch.cuda.is_available() and type(device_ids) != int and len(device_ids) > 1:
+        # One process per GPU instead of nn.DataParallel. Compiled models are recompiled in each process
+        model = getattr(model, '_orig_mod', model).to('cpu')
+        torch.multiprocessing.spawn(run_folder_mp, args=(all_mixtures_path, model, args, config), nprocs=len(device_ids))
+    else:
+        proc_list_of_files(all_mixtures_path, model, args, config, device, verbose)
 
-    for path in all_mixtures_path:
-        if not verbose:
-            all_mixtures_path.set_postfix({'track': os.path.basename(path)})
-        try:
-            # mix, sr = sf.read(path)
-            mix, sr = librosa.load(path, sr=44100, mono=False)
-            mix = mix.T
-        except Exception as e:
-            print('Can read track: {}'.format(path))
-            print('Error message: {}'.format(str(e)))
-            continue
+    time.sleep(1)
+    print("Elapsed time: {:.2f} sec".format(time.time() - start_time))
 
-        # Convert mono to stereo if needed
-        if len(mix.shape) == 1:
-            mix = np.stack([mix, mix], axis=-1)
 
-        mixture = torch.tensor(mix.T, dtype=torch.float32)
-        if args.model_type == 'htdemucs':
-            res = demix_track_demucs(config, model, mixture, device)
+def load_checkpoint(path, device, weights_only=True):
+    # Load tensors straight onto the inference device. mmap (torch >= 2.1, zip checkpoints only)
+    # lets the OS page weights in on demand instead of reading the whole file into RAM first
+    kwargs = dict(map_location=device, weights_only=weights_only)
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(path):
+        kwargs['mmap'] = True
+    return torch.load(path, **kwargs)
+
+
+def apply_inference_options(model, args, config, device, inplace=True):
+    # Copies inference options into config and applies the ones changing the model.
+    # Must be called after the checkpoint is loaded, returns the model to use.
+    # With inplace=False the given model is left untouched (--quantize works on a copy)
+    if args.infer_batch_size is not None:
+        config.inference.batch_size = args.infer_batch_size
+    if args.precision is not None:
+        config.inference.precision = args.precision
+    if args.cuda_graphs:
+        config.inference.cuda_graphs = True
+    config.inference.silence_threshold = args.silence_threshold
+
+    if str(device) == 'cpu':
+        # CPUs this process may actually run on (respects affinity / container cpusets)
+        if hasattr(os, 'sched_getaffinity'):
+            torch.set_num_threads(len(os.sched_getaffinity(0)))
         else:
-            res = demix_track(config, model, mixture, device)
-        for instr in instruments:
-            sf.write("{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], instr), res[instr].T, sr, subtype='FLOAT')
-
-        if 'vocals' in instruments and args.extract_instrumental:
-            instrum_file_name = "{}/{}_{}.wav".format(args.store_dir, os.path.basename(path)[:-4], 'instrumental')
-            sf.write(instrum_file_name, mix - res['vocals'].T, sr, subtype='FLOAT')
-
-    time.sleep(1)
-    print("Elapsed time: {:.2f} sec".format(time.time() - start_time))
+            torch.set_num_threads(os.cpu_count())
+        if args.quantize:
+            # int8 dynamic quantization of Linear and recurrent layers (Conv layers are not supported by it).
+            # A model that is already quantized has no such layers left and is returned as is
+            model = torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8, inplace=inplace)
+    elif args.compile and not hasattr(model, '_orig_mod'):
+        # Chunks have a fixed shape, so the compiled graph is reused for the whole track
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+    return model
+
+
+_PARSER = argparse.ArgumentParser()
+_PARSER.add_argument("--model_type", type=str, default='mdx23c', help="One of mdx23c, htdemucs, segm_models, mel_band_roformer, bs_roformer, swin_upernet, bandit")
+_PARSER.add_argument("--config_path", type=str, help="path to config file")
+_PARSER.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights")
+_PARSER.add_argument("--input_folder", type=str, help="folder with mixtures to process (used instead of --input_file)")
+_PARSER.add_argument("--input_file", type=str, help="path to input audio file")
+_PARSER.add_argument("--store_dir", default="", type=str, help="path to store results as wav file")
+_PARSER.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids, several GPUs are used to process --input_folder in parallel')
+_PARSER.add_argument("--extract_instrumental", action='store_true', help="invert vocals to get instrumental if provided")
+_PARSER.add_argument("--output_subtype", type=str, default='FLOAT', choices=['FLOAT', 'PCM_24', 'PCM_16'], help="sample format of output wav files (PCM_24/PCM_16 are smaller but clip at 0 dBFS)")
+_PARSER.add_argument("--precision", type=str, default=None, choices=['fp32', 'bf16', 'fp16'], help="inference precision on GPU (default: fp16 autocast, or training.use_amp for htdemucs)")
+_PARSER.add_argument("--compile", action='store_true', help="compile the model with torch.compile (GPU only, first chunks are slow while compiling)")
+_PARSER.add_argument("--cuda_graphs", action='store_true', help="replay the model forward pass as a CUDA graph (GPU only, not for models with data dependent control flow, don't combine with --compile)")
+_PARSER.add_argument("--quantize", action='store_true', help="int8 dynamic quantization of the model when running on CPU (much faster for roformer models, slightly lower quality)")
+_PARSER.add_argument("--group_duration", type=float, default=60, help="with --input_folder, short tracks are separated together in shared batches up to this total duration in seconds (0 to process tracks one by one)")
+_PARSER.add_argument("--silence_threshold", type=float, default=0, help="batches of chunks with RMS below this value (e.g. 1e-4) are not sent to the model and give silent output, slightly changes results (default 0: disabled)")
+_PARSER.add_argument("--infer_batch_size", type=int, default=None, help="number of overlapping chunks per forward pass (overrides inference.batch_size from config)")
+# pre-processing
+_PARSER.add_argument("--stereo_narrowing", type=int, default=0, help='Pre-narrowing of stereo image')
+_DEFAULT_ARGS = _PARSER.parse_args([])
+
+
+def run(model, config, device, input_file, store_dir, **kwargs):
+    # Separate a single file with an already loaded model, skipping command line parsing.
+    # Other inference options (model_type, precision, stereo_narrowing, ...) can be passed as keyword
+    # arguments and are applied the same way as on the command line, but only for this call:
+    # config and model of the caller are not modified. quantize=True quantizes a copy of the model
+    # on every call, to process many files quantize once beforehand with apply_inference_options
+    args = argparse.Namespace(**vars(_DEFAULT_ARGS))
+    args.input_file = input_file
+    args.store_dir = store_dir
+    for k, v in kwargs.items():
+        if not hasattr(args, k):
+            raise TypeError('Unknown inference option: {}'.format(k))
+        setattr(args, k, v)
+    config = copy.deepcopy(config)
+    model = apply_inference_options(model, args, config, device, inplace=False)
+    run_single_file(model, args, config, device, verbose=False)
 
 
 def proc_single_file(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model_type", type=str, default='mdx23c', help="One of mdx23c, htdemucs, segm_models, mel_band_roformer, bs_roformer, swin_upernet, bandit")
-    parser.add_argument("--config_path", type=str, help="path to config file")
-    parser.add_argument("--start_check_point", type=str, default='', help="Initial checkpoint to valid weights")
-    #parser.add_argument("--input_folder", type=str, help="folder with mixtures to process")
-    parser.add_argument("--input_file", type=str, help="path to input audio file")
-    parser.add_argument("--store_dir", default="", type=str, help="path to store results as wav file")
-    parser.add_argument("--device_ids", nargs='+', type=int, default=0, help='list of gpu ids')
-    parser.add_argument("--extract_instrumental", action='store_true', help="invert vocals to get instrumental if provided")
-	# pre-processing
-    parser.add_argument("--stereo_narrowing", type=int, default=0, help='Pre-narrowing of stereo image')
     if args is None:
-        args = parser.parse_args()
+        args = _PARSER.parse_args()
     else:
-        args = parser.parse_args(args)
-
-    torch.backends.cudnn.benchmark = True
+        args = _PARSER.parse_args(args)
 
     model, config = get_model_from_config(args.model_type, args.config_path)
-    if args.start_check_point != '':
-        print('Start from checkpoint: {}'.format(args.start_check_point))
-        state_dict = torch.load(args.start_check_point)
-        if args.model_type == 'htdemucs':
-            # Fix for htdemucs pround etrained models
-            if 'state' in state_dict:
-                state_dict = state_dict['state']
-        model.load_state_dict(state_dict)
-    print("Instruments: {}".format(config.training.instruments))
 
     if torch.cuda.is_available():
         device_ids = args.device_ids
         if type(device_ids)==int:
             device = torch.device(f'cuda:{device_ids}')
-            model = model.to(device)
         else:
             device = torch.device(f'cuda:{device_ids[0]}')
-            model = nn.DataParallel(model, device_ids=device_ids).to(device)
     else:
         device = 'cpu'
         print('CUDA is not avilable. Run inference on CPU. It will be very slow...')
-        model = model.to(device)
+    model = model.to(device)
 
-    run_single_file(model, args, config, device, verbose=False)
+    if args.start_check_point != '':
+        print('Start from checkpoint: {}'.format(args.start_check_point))
+        # htdemucs checkpoints carry pickled training objects besides the weights
+        state_dict = load_checkpoint(args.start_check_point, device, weights_only=args.model_type != 'htdemucs')
+        if args.model_type == 'htdemucs':
+            # Fix for htdemucs pround etrained models
+            if 'state' in state_dict:
+                state_dict = state_dict['state']
+        model.load_state_dict(state_dict)
+    print("Instruments: {}".format(config.training.instruments))
+
+    model = apply_inference_options(model, args, config, device)
+
+    if args.input_folder is not None:
+        run_folder(model, args, config, device, verbose=False)
+    else:
+        run_single_file(model, args, config, device, verbose=False)
 
 
 if __name__ == "__main__":
-    proc_folder(None)
+    proc_single_file(None)
@@ -2,6 +2,7 @@
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
 import time
+import weakref
 import numpy as np
 import torch
 import torch.nn as nn
@@ -64,19 +65,82 @@ def get_model_from_config(model_type, config_path):
     return model, config
 
 
+def get_autocast(device, precision, cache_enabled=True):
+    # 'fp16' / 'bf16' enable mixed precision on CUDA devices, 'fp32' disables it
+    dtypes = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+    enabled = precision in dtypes and str(device).startswith('cuda')
+    return torch.autocast('cuda', dtype=dtypes.get(precision, torch.float16), enabled=enabled, cache_enabled=cache_enabled)
+
+
+# Captured CUDA graphs per model, reused by all demix calls: {model: {(shape, dtype, device, precision): graph}}
+_CUDA_GRAPHS = weakref.WeakKeyDictionary()
+
+
+class CUDAGraphModel:
+    # Runs batches of batch_size chunks by replaying a CUDA graph, which removes per-kernel launch overhead.
+    # The graph is captured once per model, input shape and precision and reused across tracks.
+    # Other shapes (the last, shorter batch) run eagerly.
+    # The returned tensor is overwritten by the next replay, so copy it out before calling again
+    def __init__(self, model, batch_size, precision):
+        self.model = model
+        self.batch_size = batch_size
+        self.precision = precision
+
+    def capture(self, x):
+        static_in = x.clone()
+        # Warmup on a side stream, as required before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.model(static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self.model(static_in)
+        return graph, static_in, static_out
+
+    def __call__(self, x):
+        if x.shape[0] != self.batch_size:
+            return self.model(x)
+        graphs = _CUDA_GRAPHS.setdefault(self.model, {})
+        key = (tuple(x.shape), x.dtype, str(x.device), self.precision)
+        if key not in graphs:
+            graphs[key] = self.capture(x)
+        graph, static_in, static_out = graphs[key]
+        static_in.copy_(x)
+        graph.replay()
+        return static_out
+
+
+def forward_non_silent(forward, arr, silence_threshold):
+    # Skips the model for batches where every chunk has RMS below silence_threshold.
+    # Returns per chunk outputs on CPU, or None for every chunk of a skipped batch
+    if silence_threshold <= 0:
+        return list(forward(arr).cpu())
+    silent = (arr.float().pow(2).mean(dim=(1, 2)).sqrt() < silence_threshold).cpu()
+    if silent.all():
+        return [None] * arr.shape[0]
+    # Mixed batches go through the model whole (compiled models and CUDA graphs need a fixed batch shape),
+    # their outputs are all kept since the compute is already spent
+    return list(forward(arr).cpu())
+
+
 def demix_track(config, model, mix, device):
+    return demix_tracks(config, model, [mix], device)[0]
+
+
+def demix_tracks(config, model, mixes, device):
+    # Chunks of all given tracks share the model batches, so several short tracks
+    # are separated with as few (and as full) forward passes as one long track
     C = config.audio.chunk_size
     N = config.inference.num_overlap
     fade_size = C // 10
     step = int(C // N)
     border = C - step
     batch_size = config.inference.batch_size
-
-    length_init = mix.shape[-1]
-
-    # Do pad from the beginning and end to account floating window results better
-    if length_init > 2 * border and (border > 0):
-        mix = nn.functional.pad(mix, (border, border), mode='reflect')
+    precision = config.inference.get('precision', 'fp16')
+    cuda_graphs = config.inference.get('cuda_graphs', False) and str(device).startswith('cuda')
+    silence_threshold = config.inference.get('silence_threshold', 0.0)
 
     # Prepare windows arrays (do 1 time for speed up). This trick repairs click problems on the edges of segment
     window_size = C
@@ -90,107 +154,134 @@ def demix_track(config, model, mix, device):
     window_middle[-fade_size:] *= fadeout
     window_middle[:fade_size] *= fadein
 
-    with torch.cuda.amp.autocast():
+    forward = CUDAGraphModel(model, batch_size, precision) if cuda_graphs else model
+
+    # Autocast weight cache can't be used while capturing CUDA graphs
+    with get_autocast(device, precision, cache_enabled=not cuda_graphs):
         with torch.inference_mode():
             if config.training.target_instrument is not None:
-                req_shape = (1, ) + tuple(mix.shape)
+                num_sources = 1
             else:
-                req_shape = (len(config.training.instruments),) + tuple(mix.shape)
-
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    if length > C // 2 + 1:
-                        part = nn.functional.pad(input=part, pad=(0, C - length), mode='reflect')
-                    else:
-                        part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
+                num_sources = len(config.training.instruments)
 
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
+            # Cut all tracks into overlapping windows first, then run them through the model in batches
+            padded = []
+            results = []
+            counters = []
+            chunks = []
+            for t, mix in enumerate(mixes):
+                # Do pad from the beginning and end to account floating window results better
+                if mix.shape[-1] > 2 * border and (border > 0):
+                    mix = nn.functional.pad(mix, (border, border), mode='reflect')
+                padded.append(mix)
 
+                req_shape = (num_sources, ) + tuple(mix.shape)
+                results.append(torch.zeros(req_shape, dtype=torch.float32))
+                counters.append(torch.zeros(req_shape, dtype=torch.float32))
+
+                for i in range(0, mix.shape[1], step):
+                    part = mix[:, i:i + C]
+                    length = part.shape[-1]
+                    if length < C:
+                        if length > C // 2 + 1:
+                            part = nn.functional.pad(input=part, pad=(0, C - length), mode='reflect')
+                        else:
+                            part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
+                    chunks.append((t, i, part))
+
+            for b in range(0, len(chunks), batch_size):
+                batch = chunks[b:b + batch_size]
+                arr = torch.stack([part for _, _, part in batch], dim=0).to(device)
+                x = forward_non_silent(forward, arr, silence_threshold)
+
+                for j, (t, start, _) in enumerate(batch):
+                    mix_length = padded[t].shape[1]
+                    l = min(C, mix_length - start)
                     window = window_middle
-                    if i - step == 0:  # First audio chunk, no fadein
+                    if start == 0:  # First audio chunk, no fadein
                         window = window_start
-                    elif i >= mix.shape[1]:  # Last audio chunk, no fadeout
+                    elif start + step >= mix_length:  # Last audio chunk, no fadeout
                         window = window_finish
+                    # Skipped (silent) chunks add no weight either, so overlapping chunks keep their level.
+                    # Samples covered only by skipped chunks give 0/0, which nan_to_num turns into silence
+                    if x[j] is not None:
+                        results[t][..., start:start+l] += x[j][..., :l] * window[..., :l]
+                        counters[t][..., start:start+l] += window[..., :l]
 
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu() * window[..., :l]
-                        counter[..., start:start+l] += window[..., :l]
-
-                    batch_data = []
-                    batch_locations = []
+            outputs = []
+            for t, mix in enumerate(mixes):
+                estimated_sources = results[t] / counters[t]
+                estimated_sources = estimated_sources.cpu().numpy()
+                np.nan_to_num(estimated_sources, copy=False, nan=0.0)
 
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+                if mix.shape[-1] > 2 * border and (border > 0):
+                    # Remove pad
+                    estimated_sources = estimated_sources[..., border:-border]
 
-            if length_init > 2 * border and (border > 0):
-                # Remove pad
-                estimated_sources = estimated_sources[..., border:-border]
+                if config.training.target_instrument is None:
+                    outputs.append({k: v for k, v in zip(config.training.instruments, estimated_sources)})
+                else:
+                    outputs.append({k: v for k, v in zip([config.training.target_instrument], estimated_sources)})
 
-    if config.training.target_instrument is None:
-        return {k: v for k, v in zip(config.training.instruments, estimated_sources)}
-    else:
-        return {k: v for k, v in zip([config.training.target_instrument], estimated_sources)}
+    return outputs
 
 
 def demix_track_demucs(config, model, mix, device):
+    return demix_tracks_demucs(config, model, [mix], device)[0]
+
+
+def demix_tracks_demucs(config, model, mixes, device):
     S = len(config.training.instruments)
     C = config.training.samplerate * config.training.segment
     N = config.inference.num_overlap
     batch_size = config.inference.batch_size
     step = C // N
-    # print(S, C, N, step, mix.shape, mix.device)
+    precision = config.inference.get('precision', 'fp16' if config.training.use_amp else 'fp32')
+    cuda_graphs = config.inference.get('cuda_graphs', False) and str(device).startswith('cuda')
+    silence_threshold = config.inference.get('silence_threshold', 0.0)
+
+    forward = CUDAGraphModel(model, batch_size, precision) if cuda_graphs else model
 
-    with torch.cuda.amp.autocast(enabled=config.training.use_amp):
+    # Autocast weight cache can't be used while capturing CUDA graphs
+    with get_autocast(device, precision, cache_enabled=not cuda_graphs):
         with torch.inference_mode():
-            req_shape = (S, ) + tuple(mix.shape)
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
-
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu()
-                        counter[..., start:start+l] += 1.
-                    batch_data = []
-                    batch_locations = []
-
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
-
-    if S > 1:
-        return {k: v for k, v in zip(config.training.instruments, estimated_sources)}
-    else:
-        return estimated_sources
+            results = []
+            counters = []
+            chunks = []
+            for t, mix in enumerate(mixes):
+                req_shape = (S, ) + tuple(mix.shape)
+                results.append(torch.zeros(req_shape, dtype=torch.float32))
+                counters.append(torch.zeros(req_shape, dtype=torch.float32))
+
+                for i in range(0, mix.shape[1], step):
+                    part = mix[:, i:i + C]
+                    length = part.shape[-1]
+                    if length < C:
+                        part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
+                    chunks.append((t, i, part))
+
+            for b in range(0, len(chunks), batch_size):
+                batch = chunks[b:b + batch_size]
+                arr = torch.stack([part for _, _, part in batch], dim=0).to(device)
+                x = forward_non_silent(forward, arr, silence_threshold)
+                for j, (t, start, _) in enumerate(batch):
+                    l = min(C, mixes[t].shape[1] - start)
+                    if x[j] is not None:
+                        results[t][..., start:start+l] += x[j][..., :l]
+                        counters[t][..., start:start+l] += 1.
+
+            outputs = []
+            for t in range(len(mixes)):
+                estimated_sources = results[t] / counters[t]
+                estimated_sources = estimated_sources.cpu().numpy()
+                np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+
+                if S > 1:
+                    outputs.append({k: v for k, v in zip(config.training.instruments, estimated_sources)})
+                else:
+                    outputs.append(estimated_sources)
+
+    return outputs
 
 
 def sdr(references, estimates):